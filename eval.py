@@ -17,10 +17,12 @@
 
 import os
 import time
+from collections import deque
+from concurrent import futures
 import cv2
 import numpy as np
+from numba import njit
 from mindspore import DatasetHelper, load_checkpoint, context
-from mindspore.nn import Sigmoid
 
 from model_utils.config import base_config
 from src.dataset import create_dataset
@@ -61,6 +63,112 @@ def main(config):
     evaluate(test_dataset, config, dataset)
 
 
+@njit(cache=True, fastmath=True)
+def ssim(pred, gt):
+    """
+    structural similarity
+    """
+    h, w = pred.shape
+    n = h * w
+    if n == 0:
+        return np.nan
+    sx = 0.0
+    sy = 0.0
+    sxx = 0.0
+    syy = 0.0
+    sxy = 0.0
+    for i in range(h):
+        for j in range(w):
+            p = pred[i, j]
+            g = gt[i, j]
+            sx += p
+            sy += g
+            sxx += p * p
+            syy += g * g
+            sxy += p * g
+    x = sx / n
+    y = sy / n
+    sigma_x2 = (sxx - sx * x) / (n - 1 + 1e-20)
+    sigma_y2 = (syy - sy * y) / (n - 1 + 1e-20)
+    sigma_xy = (sxy - sx * y) / (n - 1 + 1e-20)
+
+    alpha = 4 * x * y * sigma_xy
+    beta = (x * x + y * y) * (sigma_x2 + sigma_y2)
+
+    if alpha != 0:
+        q = alpha / (beta + 1e-20)
+    elif beta == 0:
+        q = 1.0
+    else:
+        q = 0.0
+    return q
+
+
+@njit(cache=True)
+def level_histograms(pred, gt, thresholds):
+    """
+    histograms of the pred level (pred * 255 rounded), the gt level (number of
+    thresholds th with gt * 255 > th / thresholds) and the minimum of both
+    """
+    bins = thresholds + 1
+    hist_pred = np.zeros(bins, np.int64)
+    hist_gt = np.zeros(bins, np.int64)
+    hist_both = np.zeros(bins, np.int64)
+    pred_scale = pred.dtype.type(255)
+    gt_scale = gt.dtype.type(255 * thresholds)
+    for i in range(pred.size):
+        a = min(max(int(np.rint(pred[i] * pred_scale)), 0), thresholds)
+        b = min(max(int(np.ceil(gt[i] * gt_scale)), 0), thresholds)
+        hist_pred[a] += 1
+        hist_gt[b] += 1
+        hist_both[min(a, b)] += 1
+    return hist_pred, hist_gt, hist_both
+
+
+@njit(cache=True, fastmath=True)
+def object_score(s, s2, n):
+    """
+    compute score of object from the sum, squared sum and count of its pixels
+    """
+    if n == 0:
+        return 0.0
+    x = s / n
+    sigma_x = np.sqrt(max(s2 / n - x * x, 0.0))
+    return 2.0 * x / (x * x + 1.0 + sigma_x + 1e-20)
+
+
+@njit(cache=True, fastmath=True)
+def s_object(pred, gt):
+    """
+    score of object
+    """
+    h, w = pred.shape
+    one = pred.dtype.type(1)
+    sfg = 0.0
+    sfg2 = 0.0
+    nfg = 0
+    sbg = 0.0
+    sbg2 = 0.0
+    nbg = 0
+    for i in range(h):
+        for j in range(w):
+            p = pred[i, j]
+            g = gt[i, j]
+            if g == 1:
+                sfg += p
+                sfg2 += p * p
+                nfg += 1
+            elif g == 0:
+                b = one - p
+                sbg += b
+                sbg2 += b * b
+                nbg += 1
+    o_fg = object_score(sfg, sfg2, nfg)
+    o_bg = object_score(sbg, sbg2, nbg)
+    u = nfg / (h * w)
+    return u * o_fg + (1 - u) * o_bg
+
+
 class Metric:
     """
     for metric
@@ -79,13 +187,9 @@ class Metric:
 
     def update(self, pred, gt):
         assert pred.shape == gt.shape
-        pred = pred.astype(np.float32)
-        gt = gt.astype(np.float32)
-        norm_pred = pred / 255.0
-        norm_gt = gt / 255.0
-        self.compute_mae(norm_pred, norm_gt)
+        self.compute_mae(pred, gt)
         self.compute_precision_and_recall(pred, gt)
-        self.compute_s_measure(norm_pred, norm_gt)
+        self.compute_s_measure(pred, gt)
         self.cnt += 1
 
     def print_result(self):
@@ -101,24 +205,25 @@ class Metric:
         """
         compute the precision and recall for pred
         """
-        for th in range(self.thresholds):
-            a = np.zeros_like(pred).astype(np.int32)
-            b = np.zeros_like(pred).astype(np.int32)
-            a[pred > th] = 1
-            a[pred <= th] = 0
-            b[gt > th / self.thresholds] = 1
-            b[gt <= th / self.thresholds] = 0
-            ab = np.sum(np.bitwise_and(a, b))
-            a_sum = np.sum(a)
-            b_sum = np.sum(b)
-            self.precision[th] += (ab + self.epsilon) / (a_sum + self.epsilon)
-            self.recall[th] += (ab + self.epsilon) / (b_sum + self.epsilon)
+        hist_pred, hist_gt, hist_both = level_histograms(pred.ravel(), gt.ravel(), self.thresholds)
+        a_sum = self._count_above(hist_pred)
+        b_sum = self._count_above(hist_gt)
+        ab = self._count_above(hist_both)
+        self.precision += (ab + self.epsilon) / (a_sum + self.epsilon)
+        self.recall += (ab + self.epsilon) / (b_sum + self.epsilon)
+
+    @staticmethod
+    def _count_above(hist):
+        """
+        number of elements whose level is greater than th, for every threshold th
+        """
+        return np.cumsum(hist[::-1])[::-1][1:]
 
     def compute_mae(self, pred, gt):
         """
         compute mean average error
         """
-        self.mae += np.abs(pred - gt).mean()
+        self.mae += cv2.mean(cv2.absdiff(pred, gt))[0]
 
     def compute_s_measure(self, pred, gt):
         """
@@ -127,124 +232,50 @@ class Metric:
 
         alpha = 0.5
         y = gt.mean()
-        if y == 0:
+        if y < 1e-3:
             x = pred.mean()
             q = 1.0 - x
-        elif y == 1:
+        elif y > 1 - 1e-3:
             x = pred.mean()
             q = x
         else:
-            gt[gt >= 0.5] = 1
-            gt[gt < 0.5] = 0
-            q = alpha * self._s_object(pred, gt) + (1 - alpha) * self._s_region(pred, gt)
+            np.greater_equal(gt, 0.5, out=gt)
+            q = alpha * s_object(pred, gt) + (1 - alpha) * self._s_region(pred, gt)
             if q < 0 or np.isnan(q):
                 q = 0
         self.q += q
 
-    def _s_object(self, pred, gt):
-        """
-        score of object
-        """
-        fg = np.where(gt == 0, np.zeros_like(pred), pred)
-        bg = np.where(gt == 1, np.zeros_like(pred), 1 - pred)
-        o_fg = self._object(fg, gt)
-        o_bg = self._object(bg, 1 - gt)
-        u = gt.mean()
-        q = u * o_fg + (1 - u) * o_bg
-        return q
-
-    @staticmethod
-    def _object(pred, gt):
-        """
-        compute score of object
-        """
-        temp = pred[gt == 1]
-        if temp.size == 0:
-            return 0
-        x = temp.mean()
-        sigma_x = temp.std()
-        score = 2.0 * x / (x * x + 1.0 + sigma_x + 1e-20)
-        return score
-
     def _s_region(self, pred, gt):
         """
         compute score of region
         """
         x, y = self._centroid(gt)
-        gt1, gt2, gt3, gt4, w1, w2, w3, w4 = self._divide_gt(gt, x, y)
-        p1, p2, p3, p4 = self._divide_prediction(pred, x, y)
-        q1 = self._ssim(p1, gt1)
-        q2 = self._ssim(p2, gt2)
-        q3 = self._ssim(p3, gt3)
-        q4 = self._ssim(p4, gt4)
-        q = w1 * q1 + w2 * q2 + w3 * q3 + w4 * q4
+        parts = self._divide(pred, gt, x, y)
+        q = 0
+        for part_pred, part_gt, weight in zip(parts[:4], parts[4:8], parts[8:]):
+            if part_gt.size == 0:
+                continue
+            part_pred = np.ascontiguousarray(part_pred, dtype=np.float32)
+            part_gt = np.ascontiguousarray(part_gt, dtype=np.float32)
+            q += weight * ssim(part_pred, part_gt)
         return q
 
     @staticmethod
-    def _divide_gt(gt, x, y):
+    def _divide(pred, gt, x, y):
         """
-        divide ground truth image
+        divide predict and ground truth image into four quadrants at (x, y)
         """
-        if not isinstance(x, np.int64):
-            x = x[0][0]
-        if not isinstance(y, np.int64):
-            y = y[0][0]
         h, w = gt.shape[-2:]
         area = h * w
+        pred = pred.reshape(h, w)
         gt = gt.reshape(h, w)
-        lt = gt[:y, :x]
-        rt = gt[:y, x:w]
-        lb = gt[y:h, :x]
-        rb = gt[y:h, x:w]
-        x = x.astype(np.float32)
-        y = y.astype(np.float32)
         w1 = x * y / area
         w2 = (w - x) * y / area
         w3 = x * (h - y) / area
         w4 = 1 - w1 - w2 - w3
-        return lt, rt, lb, rb, w1, w2, w3, w4
-
-    @staticmethod
-    def _divide_prediction(pred, x, y):
-        """
-        divide predict image
-        """
-        if not isinstance(x, np.int64):
-            x = x[0][0]
-        if not isinstance(y, np.int64):
-            y = y[0][0]
-        h, w = pred.shape[-2:]
-        pred = pred.reshape(h, w)
-        lt = pred[:y, :x]
-        rt = pred[:y, x:w]
-        lb = pred[y:h, :x]
-        rb = pred[y:h, x:w]
-        return lt, rt, lb, rb
-
-    @staticmethod
-    def _ssim(pred, gt):
-        """
-        structural similarity
-        """
-        gt = gt.astype(np.float32)
-        h, w = pred.shape[-2:]
-        n = h * w
-        x = pred.mean()
-        y = gt.mean()
-        sigma_x2 = ((pred - x) * (pred - x)).sum() / (n - 1 + 1e-20)
-        sigma_y2 = ((gt - y) * (gt - y)).sum() / (n - 1 + 1e-20)
-        sigma_xy = ((pred - x) * (gt - y)).sum() / (n - 1 + 1e-20)
-
-        alpha = 4 * x * y * sigma_xy
-        beta = (x * x + y * y) * (sigma_x2 + sigma_y2)
-
-        if alpha != 0:
-            q = alpha / (beta + 1e-20)
-        elif alpha == 0 and beta == 0:
-            q = 1.0
-        else:
-            q = 0
-        return q
+        return (pred[:y, :x], pred[:y, x:w], pred[y:h, :x], pred[y:h, x:w],
+                gt[:y, :x], gt[:y, x:w], gt[y:h, :x], gt[y:h, x:w],
+                w1, w2, w3, w4)
 
     @staticmethod
     def _centroid(gt):
@@ -253,17 +284,40 @@ class Metric:
         """
         rows, cols = gt.shape[-2:]
         gt = gt.reshape(rows, cols)
-        if gt.sum() == 0:
-            x = np.eye(1) * round(cols / 2)
-            y = np.eye(1) * round(rows / 2)
-        else:
-            total = gt.sum()
+        ys, xs = np.nonzero(gt)
+        if xs.size == 0:
+            return round(cols / 2), round(rows / 2)
+        return int(round(xs.mean())), int(round(ys.mean()))
 
-            i = np.arange(0, cols).astype(np.float32)
-            j = np.arange(0, rows).astype(np.float32)
-            x = np.round((gt.sum(axis=0) * i).sum() / total)
-            y = np.round((gt.sum(axis=1) * j).sum() / total)
-        return x.astype(np.int64), y.astype(np.int64)
+
+def sigmoid(x):
+    """
+    logistic function on host, written with tanh so large logits do not overflow
+    """
+    out = x * 0.5
+    np.tanh(out, out=out)
+    out += 1
+    out *= 0.5
+    return out
+
+
+def pipelined_inference(model, dataset_helper, depth=2):
+    """
+    run model on each batch and yield (sal_pred, sal_label, name_index, time_cost)
+    once depth batches have been launched, so host work on a batch overlaps
+    device compute of the following ones
+    """
+    pending = deque()
+    for data_batch in dataset_helper:
+        sal_image, sal_label, name_index = data_batch[0], data_batch[1], data_batch[2]
+        time_start = time.time()
+        _, _, up_sal_final = model(sal_image)
+        time_end = time.time()
+        pending.append((up_sal_final[-1], sal_label, name_index, time_end - time_start))
+        if len(pending) >= depth:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
 
 
 def evaluate(test_ds, config, dataset):
@@ -272,7 +326,6 @@ def evaluate(test_ds, config, dataset):
     # Load pretrained model
     load_checkpoint(config.model, net=model)
     print(f"Loading pre-trained model from {config.model}...")
-    sigmoid = Sigmoid()
     # test phase
     test_save_name = config.test_save_name + config.base_model
     test_fold = config.test_fold
@@ -283,26 +336,29 @@ def evaluate(test_ds, config, dataset):
 
     metric = Metric()
     has_label = False
-    for i, data_batch in enumerate(dataset_helper):
-        sal_image, sal_label, name_index = data_batch[0], data_batch[1], data_batch[2]
-        name = dataset.image_list[name_index[0].asnumpy().astype(np.int32)]
-        save_file = os.path.join(test_fold, test_save_name, name[:-4] + "_sal.png")
-        directory, _ = os.path.split(save_file)
-        if not os.path.exists(directory):
-            os.makedirs(directory, exist_ok=True)
-        time_start = time.time()
-        _, _, up_sal_final = model(sal_image)
-        time_end = time.time()
-        time_t += time_end - time_start
-        pred = sigmoid(up_sal_final[-1]).asnumpy().squeeze() * 255
-
-        if sal_label is not None:
-            has_label = True
-            sal_label = sal_label.asnumpy().squeeze() * 255
-            pred = np.round(pred).astype(np.uint8)
-            metric.update(pred, sal_label)
-        cv2.imwrite(save_file, pred)
-        print(f"process image index {i} done")
+    # metric updates stay on a single worker so Metric state is never shared between threads
+    all_task = []
+    with futures.ThreadPoolExecutor(max_workers=1) as metric_tp, futures.ThreadPoolExecutor(max_workers=1) as save_tp:
+        for i, data_batch in enumerate(pipelined_inference(model, dataset_helper)):
+            sal_pred, sal_label, name_index, time_cost = data_batch
+            name = dataset.image_list[name_index[0].asnumpy().astype(np.int32)]
+            save_file = os.path.join(test_fold, test_save_name, name[:-4] + "_sal.png")
+            directory, _ = os.path.split(save_file)
+            if not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            time_t += time_cost
+            pred = sigmoid(sal_pred.asnumpy().squeeze())
+            pred_u8 = pred * 255
+            np.rint(pred_u8, out=pred_u8)
+            pred_u8 = pred_u8.astype(np.uint8)
+
+            if sal_label is not None:
+                has_label = True
+                all_task.append(metric_tp.submit(metric.update, pred, sal_label.asnumpy().squeeze()))
+            all_task.append(save_tp.submit(cv2.imwrite, save_file, pred_u8))
+            print(f"process image index {i} done")
+    for task in all_task:
+        task.result()
 
     print(f"--- {time_t} seconds ---")
     if has_label: